@@ -1,17 +1,22 @@
 # @title 啟動 AI 運算伺服器 (V8.0 - 全局平衡修正版)
 # 修正：開局位置偏差 (隨機洗牌)，不再只下上半部
-# 保持：無限思考、防呆檢查、置換表
+# 保持：防呆檢查、置換表
+# 新增：迭代加深 + 每次請求的時間預算 (取代無限思考)
 
 !pip install flask pyngrok flask-cors
 
 import os
+import sys
 import json
 import math
 import random
 import time
-import copy
 import traceback
 import functools
+import hashlib
+import collections
+import array
+import threading
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from pyngrok import ngrok
@@ -23,347 +28,1139 @@ CORS(app)
 # 1. 核心幾何邏輯 (保持 V6.0 的正確性)
 # ==========================================
 
-def get_line_id(dot1, dot2):
-    d1, d2 = dot1, dot2
-    if d1['r'] > d2['r'] or (d1['r'] == d2['r'] and d1['c'] > d2['c']):
-        d1, d2 = d2, d1
-    return f"{d1['r']},{d1['c']}_{d2['r']},{d2['c']}"
+class Dot:
+    __slots__ = ('index', 'r', 'c', 'x', 'y')
+
+    def __init__(self, index, r, c, x, y):
+        self.index = index
+        self.r = r
+        self.c = c
+        self.x = x
+        self.y = y
+
+class Segment:
+    # dot1/dot2 為點索引，key 為前端的線段 ID 字串 (只在輸出時使用)
+    __slots__ = ('index', 'key', 'dot1', 'dot2')
+
+    def __init__(self, index, key, dot1, dot2):
+        self.index = index
+        self.key = key
+        self.dot1 = dot1
+        self.dot2 = dot2
+
+class Move:
+    # 引擎內部的候選步：端點索引、整數線段 tuple 與線段位元遮罩
+    __slots__ = ('index', 'dot1', 'dot2', 'segs', 'mask')
+
+    def __init__(self, index, dot1, dot2, segs):
+        self.index = index
+        self.dot1 = dot1
+        self.dot2 = dot2
+        self.segs = segs
+        self.mask = sum(1 << seg for seg in segs)
+
+def parse_line_id(line_id):
+    # "r1,c1_r2,c2" → ((r1, c1), (r2, c2))
+    a, b = line_id.split('_')
+    r1, c1 = a.split(',')
+    r2, c2 = b.split(',')
+    return (int(r1), int(c1)), (int(r2), int(c2))
 
 def compare_dots_js_style(a, b):
     EPSILON = 1e-6
-    diff_x = a['x'] - b['x']
+    diff_x = a.x - b.x
     if abs(diff_x) > EPSILON:
         return diff_x
-    return a['y'] - b['y']
-
-def find_intermediate_dots(dotA, dotB, all_dots_flat):
-    intermediate = []
-    min_x = min(dotA['x'], dotB['x']) - 5
-    max_x = max(dotA['x'], dotB['x']) + 5
-    min_y = min(dotA['y'], dotB['y']) - 5
-    max_y = max(dotA['y'], dotB['y']) + 5
-    EPSILON = 1e-4
-
-    for dot in all_dots_flat:
-        if min_x <= dot['x'] <= max_x and min_y <= dot['y'] <= max_y:
-            cross_product = (dotB['y'] - dotA['y']) * (dot['x'] - dotB['x']) - \
-                            (dot['y'] - dotB['y']) * (dotB['x'] - dotA['x'])
-            if abs(cross_product) < EPSILON:
-                intermediate.append(dot)
+    return a.y - b.y
+
+class DotGrid:
+    # 點的均勻網格空間索引：格子邊長約為平均點距，每格記錄落在其中的點索引。
+    # 用於非格點版面的矩形範圍查詢 (共線中繼點) 與最近點查詢，避免逐點掃描全部點
+    def __init__(self, dots):
+        self.dots = dots
+        xs = [d.x for d in dots]
+        ys = [d.y for d in dots]
+        self.min_x = min(xs) if xs else 0.0
+        self.min_y = min(ys) if ys else 0.0
+        width = (max(xs) - self.min_x) if xs else 0.0
+        height = (max(ys) - self.min_y) if ys else 0.0
+        n = max(len(dots), 1)
+        if width > 1e-6 and height > 1e-6: cell = math.sqrt(width * height / n)
+        else: cell = max(width, height) / n
+        self.cell = cell if cell > 1e-6 else 1.0
+        self.cells = {}
+        for d in dots:
+            self.cells.setdefault(self.cell_of(d.x, d.y), []).append(d.index)
+        self.max_cx = max((k[0] for k in self.cells), default=0)
+        self.max_cy = max((k[1] for k in self.cells), default=0)
+
+    def cell_of(self, x, y):
+        return (int((x - self.min_x) // self.cell), int((y - self.min_y) // self.cell))
+
+    def query_rect(self, x0, y0, x1, y1):
+        # 回傳落在 [x0, x1] × [y0, y1] (含邊界) 內的點索引
+        cx0, cy0 = self.cell_of(x0, y0)
+        cx1, cy1 = self.cell_of(x1, y1)
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.cells):
+            keys = [k for k in self.cells if cx0 <= k[0] <= cx1 and cy0 <= k[1] <= cy1]
+        else:
+            keys = [(cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)]
+        dots = self.dots
+        result = []
+        for key in keys:
+            for k in self.cells.get(key, ()):
+                d = dots[k]
+                if x0 <= d.x <= x1 and y0 <= d.y <= y1: result.append(k)
+        return result
+
+    def nearest_distance(self, i):
+        # 點 i 到其他點的最短距離：由所在格子一圈一圈往外找，
+        # 第 r 圈之外的點距離至少 r 格，已找到更近的點就停止
+        d = self.dots[i]
+        cx, cy = self.cell_of(d.x, d.y)
+        max_ring = max(cx, self.max_cx - cx, cy, self.max_cy - cy)
+        best = math.inf
+        for ring in range(max_ring + 1):
+            for gx in range(cx - ring, cx + ring + 1):
+                for gy in range(cy - ring, cy + ring + 1):
+                    if max(abs(gx - cx), abs(gy - cy)) != ring: continue
+                    for k in self.cells.get((gx, gy), ()):
+                        if k == i: continue
+                        best = min(best, math.hypot(d.x - self.dots[k].x, d.y - self.dots[k].y))
+            if best <= ring * self.cell: break
+        return best
+
+def find_float_paths(dots, required_length, grid, neighbors):
+    # 非格點版面 (自訂/雲端佈局) 用的浮點幾何 (角度 0/60/120/180 ±2.5 度、±5px 邊界框內的共線點)。
+    # 合法步的沿線點必須依序以線段相連，所以終點一定在起點的 required_length 步圖距離內：
+    # 只檢查這些點對，共線中繼點以網格查詢，不再對所有點對掃描所有點。
+    # 依 (i, j) 順序產生 (i, j, 沿線點索引)，沿線點依 x 再依 y 排序
+    for i, a in enumerate(dots):
+        reach = set()
+        frontier = {i}
+        for _ in range(required_length):
+            frontier = {k for f in frontier for k in neighbors[f]} - reach
+            reach |= frontier
+        ax, ay = a.x, a.y
+        for j in sorted(k for k in reach if k > i):
+            b = dots[j]
+            bx, by = b.x, b.y
+            dx = bx - ax
+            dy = by - ay
+            if not (abs(dx) <= 0.1 and abs(dy) <= 0.1):
+                abs_angle = abs(math.degrees(math.atan2(dy, dx)))
+                if not any(abs(abs_angle - v) < 2.5 for v in (0, 60, 120, 180)): continue
+            
+            line_dots = []
+            for k in grid.query_rect(min(ax, bx) - 5, min(ay, by) - 5, max(ax, bx) + 5, max(ay, by) + 5):
+                p = dots[k]
+                if abs(dy * (p.x - bx) - (p.y - by) * dx) < 1e-4: line_dots.append(p)
+            if len(line_dots) != required_length + 1: continue
+            line_dots.sort(key=functools.cmp_to_key(compare_dots_js_style))
+            yield i, j, [d.index for d in line_dots]
+
+def compute_lattice_coords(dots, grid):
+    # 將點轉為三角格點的整數座標 (u, v)：u 以半個點距為單位、v 為列，
+    # 六個方向為 (±2, 0) 與 (±1, ±1)。版面不在格點上時回傳 None，改走浮點幾何
+    if len(dots) < 2: return None
+    spacing = min(grid.nearest_distance(d.index) for d in dots)
+    if spacing < 1e-6: return None
+    half_x = spacing / 2
+    row_h = spacing * math.sqrt(3) / 2
+    x0, y0 = dots[0].x, dots[0].y
     
-    intermediate.sort(key=functools.cmp_to_key(compare_dots_js_style))
-    return intermediate
+    coords = []
+    seen = set()
+    for d in dots:
+        fu = (d.x - x0) / half_x
+        fv = (d.y - y0) / row_h
+        u, v = round(fu), round(fv)
+        if abs(fu - u) > 0.01 or abs(fv - v) > 0.01: return None
+        if (u + v) % 2 != 0 or (u, v) in seen: return None
+        seen.add((u, v))
+        coords.append((u, v))
+    return coords
+
+# 六個格點方向 (u 以半個點距為單位)：0、60、120、180、240、300 度
+LATTICE_DIRECTIONS = [(2, 0), (1, 1), (-1, 1), (-2, 0), (-1, -1), (1, -1)]
 
-def is_valid_preview_line(dotA, dotB, current_lines, all_dots_flat, required_length):
-    if not dotA or not dotB: return False
-    dx = dotB['x'] - dotA['x']
-    dy = dotB['y'] - dotA['y']
+def zobrist_key(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'little')
+
+ZOBRIST_SIDE = zobrist_key("side:2")
+
+class BoardTopology:
+    # 每個請求只編譯一次的棋盤拓樸：點與線段轉成整數編號，
+    # 並依規則 (requiredLineLength / allowShorterLines) 預先算好候選步 (幾何只算一次)
+    # 3D 多面體 (is_3d) 直接以頂點/邊/面的圖來建：每條邊就是一步，面可以是三角形以外的多邊形
+    def __init__(self, dots_rows, lines, triangles, required_length=1, allow_shorter=False, is_3d=False):
+        self.dots = []
+        for row in dots_rows:
+            for d in row:
+                self.dots.append(Dot(len(self.dots), d['r'], d['c'], d['x'], d['y']))
+        self.dot_index = {(d.r, d.c): d.index for d in self.dots}
+        self.is_3d = is_3d
+        # 版面指紋 (由 TopologyCache 填入)
+        self.fingerprint = None
+        # 3D 的 x/y 只是旋轉後的投影座標，不能拿來做平面幾何
+        self.grid = None if is_3d else DotGrid(self.dots)
+        self.lattice_coords = None if is_3d else compute_lattice_coords(self.dots, self.grid)
+        self.lattice_index = None
+        self._rays = None
+        if self.lattice_coords is not None:
+            self.lattice_index = {uv: i for i, uv in enumerate(self.lattice_coords)}
+        
+        self.segments = []
+        self.seg_by_dots = {}
+        for key in lines.keys():
+            rc1, rc2 = parse_line_id(key)
+            a, b = self.dot_index.get(rc1, -1), self.dot_index.get(rc2, -1)
+            seg = Segment(len(self.segments), key, a, b)
+            self.segments.append(seg)
+            self.seg_by_dots[(min(a, b), max(a, b))] = seg.index
+        self.seg_keys = [seg.key for seg in self.segments]
+        # 點 → 以線段相連的點
+        self.dot_neighbors = [[] for _ in self.dots]
+        for seg in self.segments:
+            if seg.dot1 >= 0 and seg.dot2 >= 0:
+                self.dot_neighbors[seg.dot1].append(seg.dot2)
+                self.dot_neighbors[seg.dot2].append(seg.dot1)
+        self.seg_index = {k: i for i, k in enumerate(self.seg_keys)}
+        self.tri_segs = [tuple(self.seg_index[k] for k in tri['lineKeys'] if k in self.seg_index)
+                         for tri in triangles]
+        
+        # 位元盤：線段 i 對應第 i 個 bit，三角形 (3D 為任意多邊形的面) 以各邊的 bit 組成遮罩
+        # lineKeys 有缺的三角形加上永遠不會被畫的 ghost bit，使其永遠無法完成
+        ghost_bit = 1 << len(self.seg_keys)
+        self.tri_masks = []
+        for segs, tri in zip(self.tri_segs, triangles):
+            mask = 0
+            for s in segs: mask |= 1 << s
+            if len(segs) < len(tri['lineKeys']): mask |= ghost_bit
+            self.tri_masks.append(mask)
+        self.all_tris_mask = (1 << len(self.tri_masks)) - 1
+        # 差一條邊就完成 (威脅) 所需的已畫邊數：三角形為 2，正方形 3，五邊形 4
+        self.tri_threat_edges = [len(tri['lineKeys']) - 1 for tri in triangles]
+        
+        # 線段 → 相鄰三角形索引 (平面棋盤每條線段最多兩個，多面體每條邊恰好兩個面)
+        seg_tris = [[] for _ in self.seg_keys]
+        for t, segs in enumerate(self.tri_segs):
+            for seg in segs: seg_tris[seg].append(t)
+        self.seg_tris = [tuple(ts) for ts in seg_tris]
+        self.seg_tri_masks = [sum(1 << t for t in ts) for ts in self.seg_tris]
+        
+        # Zobrist 鍵：線段依 (owner, sharedBy) 9 種已畫狀態、三角形依填色玩家各一把
+        # 由 ID 字串決定，跨請求 (甚至跨程序) 都穩定
+        self.zobrist_lines = [tuple(zobrist_key(f"L{key}:{owner}:{shared}")
+                                    for owner in range(3) for shared in range(3))
+                              for key in self.seg_keys]
+        self.zobrist_tris = [tuple(zobrist_key(f"T{'|'.join(sorted(tri['lineKeys']))}:{p}") for p in range(3))
+                             for tri in triangles]
+        
+        # 允許短線時，長度 1..requiredLineLength 的候選步都收錄 (短的在前)
+        # 3D 沒有平面中繼點，與前端相同：每條邊本身就是一步，不受線長規則影響
+        self.required_length = required_length
+        self.allow_shorter = allow_shorter
+        if is_3d:
+            found = [(min(seg.dot1, seg.dot2), max(seg.dot1, seg.dot2), (seg.index,)) for seg in self.segments]
+        else:
+            lengths = range(1, required_length + 1) if allow_shorter else [required_length]
+            found = []
+            for length in lengths:
+                found.extend(self._find_lines(length))
+        self.moves = [Move(index, i, j, segs) for index, (i, j, segs) in enumerate(found)]
+        self.move_masks = [m.mask for m in self.moves]
+        # 線段 → 含有該線段的候選步 (以候選步索引為 bit 的遮罩)，用來增量維護合法步集合
+        seg_move_masks = [0] * len(self.segments)
+        for move in self.moves:
+            for seg in move.segs: seg_move_masks[seg] |= 1 << move.index
+        self.seg_move_masks = seg_move_masks
+        # 線長 > 1 時不同的候選步可能只剩同一批未畫線段，需在產生步時合併
+        self.merge_duplicates = required_length > 1 and not is_3d
+
+    def get_rays(self):
+        # 格點版面的方向射線表：rays[i][d][k-1] = (終點, 沿線線段 tuple)，
+        # 為點 i 沿第 d 個方向走 k 步的結果；只收錄整段線段都存在的長度。
+        # 線段 tuple 依 x 由小到大排列 (與前端 findIntermediateDots 相同)
+        if self._rays is None:
+            rays = []
+            for i, (u, v) in enumerate(self.lattice_coords):
+                dot_rays = []
+                for du, dv in LATTICE_DIRECTIONS:
+                    ray = []
+                    segs = []
+                    prev = i
+                    while True:
+                        step = len(ray) + 1
+                        nxt = self.lattice_index.get((u + du * step, v + dv * step))
+                        if nxt is None: break
+                        seg = self.seg_by_dots.get((min(prev, nxt), max(prev, nxt)))
+                        if seg is None: break
+                        segs.append(seg)
+                        ray.append((nxt, tuple(reversed(segs)) if du < 0 else tuple(segs)))
+                        prev = nxt
+                    dot_rays.append(ray)
+                rays.append(dot_rays)
+            self._rays = rays
+        return self._rays
+
+    def _find_lines(self, length):
+        # 回傳長度為 length 的所有 (i, j, 線段 tuple)，i < j
+        if self.lattice_coords is not None:
+            # 長度 k 的步只是查表：每條線從兩端各出現一次，只保留 i < j 的那一次
+            found = []
+            for i, dot_rays in enumerate(self.get_rays()):
+                for ray in dot_rays:
+                    if len(ray) >= length:
+                        j, segs = ray[length - 1]
+                        if j > i: found.append((i, j, segs))
+            found.sort()
+        else:
+            found = []
+            for i, j, path in find_float_paths(self.dots, length, self.grid, self.dot_neighbors):
+                segs = []
+                for k in range(len(path) - 1):
+                    a, b = path[k], path[k + 1]
+                    seg = self.seg_by_dots.get((min(a, b), max(a, b)))
+                    if seg is None: break
+                    segs.append(seg)
+                else:
+                    found.append((i, j, tuple(segs)))
+        return found
+
+def find_all_valid_moves(state, topology, player):
+    # 合法步 (至少有一段尚未畫過) 已由 make_move/unmake_move 增量維護在 state.legal，
+    # 這裡只需把 bit 展開成候選步索引 (由小到大)
+    result = []
+    legal = state.legal
+    while legal:
+        low = legal & -legal
+        result.append(low.bit_length() - 1)
+        legal ^= low
+    if not topology.merge_duplicates:
+        return result
     
-    if abs(dx) > 0.1 or abs(dy) > 0.1:
-        angle = math.atan2(dy, dx) * 180 / math.pi
-        abs_angle = abs(angle)
-        valid = False
-        for v in [0, 60, 120, 180]:
-            if abs(abs_angle - v) < 2.5:
-                valid = True
-                break
-        if not valid: return False
+    # 效果相同 (新畫的線段與會被共享的對手線段都一樣) 的候選步只保留第一個 (最短的)
+    move_masks = topology.move_masks
+    undrawn = ~state.drawn
+    sharable = (state.p2 if player == 1 else state.p1) & ~(state.shared1 | state.shared2)
+    seen = set()
+    merged = []
+    for i in result:
+        mask = move_masks[i]
+        effect = (mask & undrawn, mask & sharable)
+        if effect in seen: continue
+        seen.add(effect)
+        merged.append(i)
+    return merged
+
+class SearchState:
+    # 搜尋用的位元盤狀態 (原地修改)：全部以 Python int 位元遮罩表示
+    # drawn/p1/p2/shared1/shared2 以線段為 bit，filled/filled1/filled2 以三角形為 bit
+    # p1_threats/p2_threats 為隨下子/悔棋增量維護的威脅計數，hash 為增量維護的 Zobrist 鍵
+    # legal 以候選步索引為 bit，記錄目前仍合法的候選步
+    # seg_complete/seg_setup 為每條線段的「已畫鄰邊」計數 (排序用)：相鄰未完成三角形中，
+    # 其餘邊已全畫 (畫這條就完成) / 只差這條以外的一條 (畫這條會送出威脅) 的個數
+    __slots__ = ('drawn', 'p1', 'p2', 'shared1', 'shared2', 'filled', 'filled1', 'filled2',
+                 'p1_threats', 'p2_threats', 'hash', 'legal', 'seg_complete', 'seg_setup')
+
+    def __init__(self, drawn=0, p1=0, p2=0, shared1=0, shared2=0, filled=0, filled1=0, filled2=0):
+        self.drawn = drawn
+        self.p1 = p1
+        self.p2 = p2
+        self.shared1 = shared1
+        self.shared2 = shared2
+        self.filled = filled
+        self.filled1 = filled1
+        self.filled2 = filled2
+        self.p1_threats = 0
+        self.p2_threats = 0
+        self.hash = 0
+        self.legal = 0
+        self.seg_complete = None
+        self.seg_setup = None
 
-    dots_on_line = find_intermediate_dots(dotA, dotB, all_dots_flat)
-    segment_ids = []
-    for i in range(len(dots_on_line) - 1):
-        segment_ids.append(get_line_id(dots_on_line[i], dots_on_line[i+1]))
+def encode_state(lines, triangles, topology):
+    state = SearchState()
+    for i, key in enumerate(topology.seg_keys):
+        l = lines[key]
+        if not l['drawn']: continue
+        bit = 1 << i
+        state.drawn |= bit
+        owner = l['player'] if l['player'] in (1, 2) else 0
+        if owner == 1: state.p1 |= bit
+        elif owner == 2: state.p2 |= bit
+        shared_by = l.get('sharedBy', 0)
+        if shared_by not in (1, 2): shared_by = 0
+        if shared_by == 1: state.shared1 |= bit
+        elif shared_by == 2: state.shared2 |= bit
+        state.hash ^= topology.zobrist_lines[i][owner * 3 + shared_by]
     
-    if len(segment_ids) != required_length: return False
+    for i, tri in enumerate(triangles):
+        if not tri['filled']: continue
+        bit = 1 << i
+        state.filled |= bit
+        owner = tri['player'] if tri['player'] in (1, 2) else 0
+        if owner == 1: state.filled1 |= bit
+        elif owner == 2: state.filled2 |= bit
+        state.hash ^= topology.zobrist_tris[i][owner]
     
-    all_segments_exist = True
-    has_undrawn = False
+    init_search_counters(state, topology)
+    return state
+
+def init_search_counters(state, topology):
+    # 由位元盤重新計算增量維護的威脅計數、排序計數與合法步集合
+    state.p1_threats = 0
+    state.p2_threats = 0
+    update_threats(state, topology.all_tris_mask & ~state.filled, topology, 1)
+    state.seg_complete = [0] * len(topology.segments)
+    state.seg_setup = [0] * len(topology.segments)
+    update_order_counts(state, topology.all_tris_mask & ~state.filled, topology, 1)
+    undrawn = ~state.drawn
+    state.legal = 0
+    for i, mask in enumerate(topology.move_masks):
+        if mask & undrawn: state.legal |= 1 << i
+
+def get_threat_owner(state, tri_mask, threat_edges=2):
+    # 只差一條邊 (三角形為兩邊已畫) 的面歸屬於擁有較多邊 (含共享) 的玩家；否則 0
+    drawn_edges = tri_mask & state.drawn
+    if drawn_edges.bit_count() != threat_edges: return 0
+    p1_cnt = (drawn_edges & state.p1).bit_count() + (drawn_edges & state.shared1).bit_count()
+    p2_cnt = (drawn_edges & state.p2).bit_count() + (drawn_edges & state.shared2).bit_count()
+    if p1_cnt > p2_cnt: return 1
+    if p2_cnt > p1_cnt: return 2
+    return 0
+
+def update_threats(state, tris, topology, sign):
+    # 將 tris (三角形位元遮罩) 目前的威脅計入 (sign=1) 或扣除 (sign=-1)
+    tri_masks = topology.tri_masks
+    tri_threat_edges = topology.tri_threat_edges
+    while tris:
+        low = tris & -tris
+        t = low.bit_length() - 1
+        owner = get_threat_owner(state, tri_masks[t], tri_threat_edges[t])
+        if owner == 1: state.p1_threats += sign
+        elif owner == 2: state.p2_threats += sign
+        tris ^= low
+
+def update_order_counts(state, tris, topology, sign):
+    # 將 tris (未完成三角形的位元遮罩) 對各邊「已畫鄰邊」計數的貢獻計入或扣除
+    tri_masks = topology.tri_masks
+    tri_segs = topology.tri_segs
+    tri_threat_edges = topology.tri_threat_edges
+    seg_complete = state.seg_complete
+    seg_setup = state.seg_setup
+    drawn = state.drawn
+    while tris:
+        low = tris & -tris
+        t = low.bit_length() - 1
+        tri_drawn = tri_masks[t] & drawn
+        count = tri_drawn.bit_count()
+        need = tri_threat_edges[t]
+        if count >= need - 1:
+            for seg in tri_segs[t]:
+                others = count - ((tri_drawn >> seg) & 1)
+                if others == need: seg_complete[seg] += sign
+                elif others == need - 1: seg_setup[seg] += sign
+        tris ^= low
+
+def get_adjacent_tris(seg_bits, topology):
+    seg_tri_masks = topology.seg_tri_masks
+    tris = 0
+    while seg_bits:
+        low = seg_bits & -seg_bits
+        tris |= seg_tri_masks[low.bit_length() - 1]
+        seg_bits ^= low
+    return tris
+
+def get_line_hash_delta(new_bits, share_bits, topology, player):
+    # 新畫線段 (owner=player) 與新共享線段 (sharedBy 0 → player) 造成的 Zobrist 變化
+    opponent = 2 if player == 1 else 1
+    zobrist_lines = topology.zobrist_lines
+    h = 0
+    bits = new_bits
+    while bits:
+        low = bits & -bits
+        h ^= zobrist_lines[low.bit_length() - 1][player * 3]
+        bits ^= low
+    bits = share_bits
+    while bits:
+        low = bits & -bits
+        keys = zobrist_lines[low.bit_length() - 1]
+        h ^= keys[opponent * 3] ^ keys[opponent * 3 + player]
+        bits ^= low
+    return h
+
+def get_tri_hash_delta(completed, topology, player):
+    zobrist_tris = topology.zobrist_tris
+    h = 0
+    while completed:
+        low = completed & -completed
+        h ^= zobrist_tris[low.bit_length() - 1][player]
+        completed ^= low
+    return h
+
+def get_completed_tris(tris, drawn, topology):
+    # tris 之中所有邊都已畫的三角形
+    tri_masks = topology.tri_masks
+    completed = 0
+    while tris:
+        low = tris & -tris
+        tri_mask = tri_masks[low.bit_length() - 1]
+        if (tri_mask & drawn) == tri_mask:
+            completed |= low
+        tris ^= low
+    return completed
+
+def make_move(state, move_mask, topology, player):
+    # 原地下子，回傳悔棋紀錄
+    # (player, 新畫線段, 新共享線段, 完成的三角形, 受影響的三角形, 原 hash, 失效的候選步)
+    # 無效步回傳 None
+    new_bits = move_mask & ~state.drawn
+    if not new_bits: return None
     
-    for sid in segment_ids:
-        if sid not in current_lines:
-            all_segments_exist = False
-            break
-        if not current_lines[sid]['drawn']:
-            has_undrawn = True
-            
-    if not all_segments_exist: return False
-    if not has_undrawn: return False
-    return True
-
-def find_all_valid_moves(lines, dots_flat, required_length):
-    moves = []
-    count = len(dots_flat)
-    for i in range(count):
-        for j in range(i + 1, count):
-            dotA = dots_flat[i]
-            dotB = dots_flat[j]
-            if is_valid_preview_line(dotA, dotB, lines, dots_flat, required_length):
-                dots_on_line = find_intermediate_dots(dotA, dotB, dots_flat)
-                seg_ids = [get_line_id(dots_on_line[k], dots_on_line[k+1]) for k in range(len(dots_on_line)-1)]
-                moves.append({
-                    'dot1': dotA,
-                    'dot2': dotB,
-                    'segmentIds': seg_ids
-                })
-    return moves
-
-def simulate_move(move, lines, triangles, player):
-    new_lines = copy.deepcopy(lines)
-    new_triangles = copy.deepcopy(triangles)
+    # 對手已畫的線段 (且尚未共享) 變成共享
+    opponent_mask = state.p2 if player == 1 else state.p1
+    share_bits = move_mask & opponent_mask & ~(state.shared1 | state.shared2)
     
-    score_gained = 0
-    new_segment_drawn = False
+    old_hash = state.hash
+    h = old_hash ^ get_line_hash_delta(new_bits, share_bits, topology, player)
     
-    for sid in move['segmentIds']:
-        if sid in new_lines:
-            if not new_lines[sid]['drawn']:
-                new_lines[sid]['drawn'] = True
-                new_lines[sid]['player'] = player
-                new_segment_drawn = True
-            elif new_lines[sid]['player'] != 0 and new_lines[sid]['player'] != player:
-                if new_lines[sid]['sharedBy'] == 0:
-                    new_lines[sid]['sharedBy'] = player
+    # 只有相鄰的未完成三角形會改變：先扣掉它們原本的威脅
+    touched = get_adjacent_tris(new_bits | share_bits, topology) & ~state.filled
+    update_threats(state, touched, topology, -1)
+    update_order_counts(state, touched, topology, -1)
     
-    if not new_segment_drawn: return None
+    state.drawn |= new_bits
+    if player == 1:
+        state.p1 |= new_bits
+        state.shared1 |= share_bits
+    else:
+        state.p2 |= new_bits
+        state.shared2 |= share_bits
     
-    for tri in new_triangles:
-        if not tri['filled']:
-            is_complete = True
-            for key in tri['lineKeys']:
-                if key not in new_lines or not new_lines[key]['drawn']:
-                    is_complete = False
-                    break
-            if is_complete:
-                tri['filled'] = True
-                tri['player'] = player
-                score_gained += 1
-                
-    return {'newLines': new_lines, 'newTriangles': new_triangles, 'scoreGained': score_gained}
-
-def evaluate_board(lines, triangles, weights):
+    drawn = state.drawn
+    completed = get_completed_tris(touched, drawn, topology)
+    if completed:
+        state.filled |= completed
+        if player == 1: state.filled1 |= completed
+        else: state.filled2 |= completed
+        h ^= get_tri_hash_delta(completed, topology, player)
+    state.hash = h
+    
+    update_threats(state, touched & ~completed, topology, 1)
+    update_order_counts(state, touched & ~completed, topology, 1)
+    
+    # 只有含新畫線段的候選步可能失效：全部線段都已畫過的從合法集合移除
+    seg_move_masks = topology.seg_move_masks
+    affected = 0
+    bits = new_bits
+    while bits:
+        low = bits & -bits
+        affected |= seg_move_masks[low.bit_length() - 1]
+        bits ^= low
+    affected &= state.legal
+    move_masks = topology.move_masks
+    removed = 0
+    undrawn = ~drawn
+    while affected:
+        low = affected & -affected
+        if not move_masks[low.bit_length() - 1] & undrawn:
+            removed |= low
+        affected ^= low
+    state.legal ^= removed
+    return (player, new_bits, share_bits, completed, touched, old_hash, removed)
+
+def unmake_move(state, undo, topology):
+    # 以 XOR 還原 make_move 改過的位元 (含合法步集合)，並還原受影響三角形的威脅/排序計數與 hash
+    player, new_bits, share_bits, completed, touched, old_hash, removed = undo
+    state.hash = old_hash
+    state.legal ^= removed
+    update_threats(state, touched & ~completed, topology, -1)
+    update_order_counts(state, touched & ~completed, topology, -1)
+    state.drawn ^= new_bits
+    state.filled ^= completed
+    if player == 1:
+        state.p1 ^= new_bits
+        state.shared1 ^= share_bits
+        state.filled1 ^= completed
+    else:
+        state.p2 ^= new_bits
+        state.shared2 ^= share_bits
+        state.filled2 ^= completed
+    update_threats(state, touched, topology, 1)
+    update_order_counts(state, touched, topology, 1)
+
+# 不可變的盤面快照：只有 9 個 int (位元遮罩與 hash)，子節點與父節點共用沒變的 int，
+# 可大量保存 (樹搜尋的節點、去重用的 key) 或直接 pickle 傳給其他程序
+StateSnapshot = collections.namedtuple('StateSnapshot', ['drawn', 'p1', 'p2', 'shared1', 'shared2',
+                                                         'filled', 'filled1', 'filled2', 'hash'])
+
+def snapshot_state(state):
+    return StateSnapshot(state.drawn, state.p1, state.p2, state.shared1, state.shared2,
+                         state.filled, state.filled1, state.filled2, state.hash)
+
+def restore_state(snapshot, topology):
+    # 由快照重建可原地修改的 SearchState (威脅、排序計數與合法步重新計算)
+    state = SearchState(*snapshot[:8])
+    state.hash = snapshot.hash
+    init_search_counters(state, topology)
+    return state
+
+def play_snapshot(snapshot, move_mask, topology, player):
+    # make_move 的不可變版本：回傳 (子快照, 完成的三角形)，無效步回傳 None
+    drawn, p1, p2, shared1, shared2, filled, filled1, filled2, h = snapshot
+    new_bits = move_mask & ~drawn
+    if not new_bits: return None
+    share_bits = move_mask & (p2 if player == 1 else p1) & ~(shared1 | shared2)
+    h ^= get_line_hash_delta(new_bits, share_bits, topology, player)
+    
+    drawn |= new_bits
+    if player == 1:
+        p1 |= new_bits
+        shared1 |= share_bits
+    else:
+        p2 |= new_bits
+        shared2 |= share_bits
+    completed = get_completed_tris(get_adjacent_tris(new_bits, topology) & ~filled, drawn, topology)
+    if completed:
+        filled |= completed
+        if player == 1: filled1 |= completed
+        else: filled2 |= completed
+        h ^= get_tri_hash_delta(completed, topology, player)
+    return StateSnapshot(drawn, p1, p2, shared1, shared2, filled, filled1, filled2, h), completed
+
+def is_terminal(state, topology):
+    return state.filled == topology.all_tris_mask
+
+def evaluate_board(state, weights):
+    # 葉節點只讀取增量維護的計數
     w = weights or {}
     score_scale = w.get('scoreScale', 150)
     p1_threat_val = w.get('p1ThreatVal', 30)
     p2_threat_val = w.get('p2ThreatVal', -30)
     
-    p2_score = 0
-    p1_score = 0
-    p1_threats = 0
-    p2_threats = 0
+    return (state.filled2.bit_count() - state.filled1.bit_count()) * score_scale + \
+           (state.p1_threats * p1_threat_val + state.p2_threats * p2_threat_val)
+
+def get_move_order_class(segs, state):
+    # 由這步自己的線段讀取「已畫鄰邊」計數：會完成三角形 (第三邊) 100、
+    # 會留下只差一邊的三角形 -10、其他 0。直線上的線段不會屬於同一個三角形，計數可直接相加
+    seg_complete = state.seg_complete
+    seg_setup = state.seg_setup
+    is_bad_move = False
+    for seg in segs:
+        if seg_complete[seg]: return 100
+        if seg_setup[seg]: is_bad_move = True
+    return -10 if is_bad_move else 0
+
+class MoveHistory:
+    # 同一優先級內的排序依據：每層 (ply) 兩個 killer 步，加上每個候選步、每一方的 history 分數。
+    # 發生 beta 剪枝的步記為 killer，history 加上 depth²。每個請求各自建一份 (放在 SearchContext)，
+    # 多執行緒同時處理不同版面的請求時不會互相改到對方的表
+    MAX_PLY = 64
+
+    def __init__(self, topology):
+        n = len(topology.moves)
+        self.history = [[0] * n, [0] * n, [0] * n]
+        self.killers = [[-1, -1] for _ in range(self.MAX_PLY)]
+        self.nodes = 0
+        self.cutoffs = 0
+        self.first_cutoffs = 0
+
+    def record_cutoff(self, move_id, player, depth, ply, is_first):
+        self.cutoffs += 1
+        if is_first: self.first_cutoffs += 1
+        self.history[player][move_id] += depth * depth
+        if ply < self.MAX_PLY:
+            killers = self.killers[ply]
+            if killers[0] != move_id:
+                killers[1] = killers[0]
+                killers[0] = move_id
+
+def get_ordered_moves(move_ids, state, topology, history=None, player=0, ply=-1):
+    # 依優先級穩定排序；搜尋中 (給了 history/player/ply) 同一優先級內再以 killer、history 排序
+    moves = topology.moves
+    if history is None:
+        scored_moves = [(get_move_order_class(moves[move_id].segs, state), move_id) for move_id in move_ids]
+        scored_moves.sort(key=lambda x: x[0], reverse=True)
+        return [x[1] for x in scored_moves]
+    scores = history.history[player]
+    killers = history.killers[ply] if 0 <= ply < MoveHistory.MAX_PLY else ()
+    scored_moves = [(get_move_order_class(moves[move_id].segs, state), move_id in killers, scores[move_id], move_id)
+                    for move_id in move_ids]
+    scored_moves.sort(key=lambda x: x[:3], reverse=True)
+    return [x[3] for x in scored_moves]
+
+def generate_macro_moves(state, topology, player, search, max_states=16, ply=-1):
+    # 「得分後再走一步」規則下的整回合走法 (macro-move)：得分步之後由同一玩家繼續，
+    # 直到走出不得分的一步、棋局結束或無步可走。回傳候選步索引 tuple 的串列，
+    # 中途與結束盤面都以快照去重，同一批得分換個順序只會展開一次。
+    # 互不相干的得分步很多時，「先吃哪些再停」的組合是指數級的：每個中途盤面的第一個得分步
+    # 一定往下吃 (只有一個得分步的連鎖也是如此)，其餘分支最多再展開 max_states 個，
+    # 用完後仍沿第一個得分步吃到底，長連鎖不會被截斷。
+    # 結束回合的不得分步依 ply 的 killer/history 排序
+    turns = []
+    seen_mid = set()
+    seen_end = set()
+    # 已展開的「其他分支」數 (每個中途盤面第一個得分步之外的得分步)
+    branches = [0]
+    moves = topology.moves
+    move_masks = topology.move_masks
     
-    for tri in triangles:
-        if tri['filled']:
-            if tri['player'] == 2: p2_score += 1
-            elif tri['player'] == 1: p1_score += 1
-        else:
-            drawn_count = 0
-            owners = []
-            for key in tri['lineKeys']:
-                l = lines.get(key)
-                if l and l['drawn']:
-                    drawn_count += 1
-                    owners.append(l['player'])
-                    if l.get('sharedBy', 0) != 0: owners.append(l['sharedBy'])
-            
-            if drawn_count == 2:
-                p1_cnt = owners.count(1)
-                p2_cnt = owners.count(2)
-                if p1_cnt > p2_cnt: p1_threats += 1
-                elif p2_cnt > p1_cnt: p2_threats += 1
-
-    return (p2_score - p1_score) * score_scale + \
-           (p1_threats * p1_threat_val + p2_threats * p2_threat_val)
-
-def get_ordered_moves(all_moves, lines, triangles):
-    scored_moves = []
-    for move in all_moves:
-        priority = 0
-        m_ids = set(move['segmentIds'])
+    def expand(prefix, gained):
+        search.check_time()
+        legal_moves = find_all_valid_moves(state, topology, player)
+        if not legal_moves and prefix:
+            turns.append((gained, prefix))
+            return
+        # 會完成三角形的步 (排序類別 100) 就是得分步，其餘步結束這一回合
+        scoring = []
+        quiet = []
+        for move_id in legal_moves:
+            if get_move_order_class(moves[move_id].segs, state) == 100: scoring.append(move_id)
+            else: quiet.append(move_id)
         
-        is_third_edge = False
-        is_bad_move = False
+        # 白吃：受影響的三角形全部被完成，盤面其他部分不變且仍輪到自己，
+        # 先吃一定不會更差，且與其他步可交換順序，只展開這一支
+        for move_id in scoring:
+            undo = make_move(state, move_masks[move_id], topology, player)
+            if undo[4] == undo[3] and not is_terminal(state, topology):
+                expand(prefix + (move_id,), gained + undo[3].bit_count())
+                unmake_move(state, undo, topology)
+                return
+            unmake_move(state, undo, topology)
         
-        for tri in triangles:
-            if not tri['filled']:
-                existing = 0
-                has_target = False
-                for key in tri['lineKeys']:
-                    if key in m_ids: has_target = True
-                    elif lines[key]['drawn']: existing += 1
-                
-                if has_target:
-                    if existing == 2: is_third_edge = True
-                    elif existing == 1: is_bad_move = True
+        continued = False
+        for move_id in scoring:
+            undo = make_move(state, move_masks[move_id], topology, player)
+            score_gained = undo[3].bit_count()
+            key = snapshot_state(state)
+            if not is_terminal(state, topology):
+                if key not in seen_mid and (not continued or branches[0] < max_states):
+                    seen_mid.add(key)
+                    if continued: branches[0] += 1
+                    continued = True
+                    expand(prefix + (move_id,), gained + score_gained)
+            elif key not in seen_end:
+                seen_end.add(key)
+                turns.append((gained + score_gained, prefix + (move_id,)))
+            unmake_move(state, undo, topology)
         
-        if is_third_edge: priority = 100
-        elif is_bad_move: priority = -10
-        
-        scored_moves.append((priority, move))
-        
-    scored_moves.sort(key=lambda x: x[0], reverse=True)
-    return [x[1] for x in scored_moves]
+        # 不得分的步只需要結束盤面的快照來去重，不必真的下子
+        snapshot = snapshot_state(state)
+        for move_id in get_ordered_moves(quiet, state, topology, search.history, player, ply):
+            key = play_snapshot(snapshot, move_masks[move_id], topology, player)[0]
+            if key in seen_end: continue
+            seen_end.add(key)
+            turns.append((gained, prefix + (move_id,)))
+    
+    expand((), 0)
+    turns.sort(key=lambda x: x[0], reverse=True)
+    return [turn for _, turn in turns]
 
 # ==========================================
-# 2. 進階 AI (置換表 + 無限時間 Minimax)
+# 2. 進階 AI (置換表 + 限時迭代加深 Minimax)
 # ==========================================
 
-transposition_table = {}
+class TranspositionTable:
+    # 固定大小的置換表：以 array 模組的平行陣列預先配置，記憶體用量由 max_mb 決定，不會隨搜尋成長。
+    # 每個桶兩格：第 0 格深度優先 (較深或舊世代的才會被取代)，第 1 格每次都覆蓋。
+    # 每格存 64 位元鍵 (驗證用)、深度、分數、界限旗標 (0 精確、1 下界、2 上界)、
+    # 最佳回合結束時那一步的候選步編號 (-1 表示沒有) 與寫入時的世代 (0 表示空格)
+    SLOT_BYTES = 8 + 8 + 2 + 1 + 1 + 4
 
-def get_board_hash(lines, triangles, player):
-    drawn_lines = []
-    for k in sorted(lines.keys()):
-        l = lines[k]
-        if l['drawn']:
-            drawn_lines.append(f"{k}{l['player']}")
-            
-    filled_tris = []
-    for i, t in enumerate(triangles):
-        if t['filled']:
-            filled_tris.append(f"{i}{t['player']}")
-            
-    return hash( (tuple(drawn_lines), tuple(filled_tris), player) )
-
-def minimax(lines, triangles, dots_flat, depth, is_maximizing, alpha, beta, weights, req_len, is_score_again):
-    board_hash = get_board_hash(lines, triangles, 2 if is_maximizing else 1)
-    if board_hash in transposition_table:
-        entry = transposition_table[board_hash]
-        if entry['depth'] >= depth:
-            if entry['flag'] == 0: return entry['score']
-            if entry['flag'] == 1: alpha = max(alpha, entry['score'])
-            if entry['flag'] == 2: beta = min(beta, entry['score'])
-            if alpha >= beta: return entry['score']
-
-    if depth <= 0 or all(t['filled'] for t in triangles):
-        return evaluate_board(lines, triangles, weights)
-    
-    all_moves = find_all_valid_moves(lines, dots_flat, req_len)
-    if not all_moves:
-        return evaluate_board(lines, triangles, weights)
+    def __init__(self, max_mb=64):
+        buckets = 1
+        while buckets * 4 * self.SLOT_BYTES <= max_mb * 1024 * 1024: buckets *= 2
+        self.mask = buckets - 1
+        self.slots = buckets * 2
+        self.generation = 1
+        # 伺服器以多執行緒處理請求，讀寫一格要好幾次陣列存取，以鎖避免讀到寫到一半的格子
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        n = self.slots
+        self.keys = array.array('Q', bytes(8 * n))
+        self.scores = array.array('d', bytes(8 * n))
+        self.depths = array.array('h', bytes(2 * n))
+        self.flags = array.array('B', bytes(n))
+        self.ages = array.array('B', bytes(n))
+        self.moves = array.array('i', bytes(4 * n))
+        self.used = 0
+
+    def new_search(self):
+        # 每次請求開始時推進世代 (1..255 循環)，沿用先前請求留下的深層結果。
+        # 不同版面、規則或評估權重的局面由鍵裡混入的 salt 區分，不需要清表
+        with self.lock:
+            self.generation = self.generation % 255 + 1
+
+    def probe(self, key):
+        # 回傳 (深度, 分數, 旗標, 最佳步)，沒有時回傳 None
+        slot = (key & self.mask) << 1
+        with self.lock:
+            keys = self.keys
+            ages = self.ages
+            if keys[slot] != key or not ages[slot]:
+                slot += 1
+                if keys[slot] != key or not ages[slot]: return None
+            return self.depths[slot], self.scores[slot], self.flags[slot], self.moves[slot]
+
+    def store(self, key, depth, score, flag, move):
+        slot = (key & self.mask) << 1
+        with self.lock:
+            age = self.ages[slot]
+            # 深度優先格：空格、同一局面、舊世代或不比新結果深時取代，否則寫入每次覆蓋格
+            if age and self.keys[slot] != key and age == self.generation and self.depths[slot] > depth:
+                slot += 1
+                age = self.ages[slot]
+            if not age: self.used += 1
+            self.keys[slot] = key
+            self.depths[slot] = depth
+            self.scores[slot] = score
+            self.flags[slot] = flag
+            self.moves[slot] = move
+            self.ages[slot] = self.generation
+
+    def __len__(self):
+        return self.used
 
-    # 這裡的 moves 排序也需要注意，我們只對優先級做排序，同優先級隨機
-    # get_ordered_moves 內部目前是穩定排序，我們讓外部傳進來前先 shuffle 即可
-    ordered_moves = get_ordered_moves(all_moves, lines, triangles)
+transposition_table = TranspositionTable()
+
+# 每次請求的預設思考時間 (秒)，請求可用 timeLimit 覆蓋
+DEFAULT_TIME_LIMIT = 5.0
+
+# 渴望視窗的初始半寬 (小於一格的 5000 分，大於威脅分數的變動) 與放寬到全開前的上限
+ASPIRATION_WINDOW = 250
+ASPIRATION_MAX_WINDOW = 20000
+
+class SearchTimeout(Exception):
+    # 時間預算用完，放棄目前這一輪迭代
+    pass
+
+class SearchContext:
+    # 單一請求的搜尋狀態 (期限、節點數、killer/history 表與置換表 salt)：每個請求各自一份，一路傳進 minimax，
+    # 伺服器以多執行緒同時處理多個請求時彼此的期限不會互相覆蓋
+    def __init__(self, deadline=math.inf, history=None, salt=0):
+        self.deadline = deadline
+        self.nodes = 0
+        self.history = history
+        self.salt = salt
+
+    def check_time(self):
+        # 每 256 個節點看一次時鐘，超過期限就中斷整個搜尋
+        self.nodes += 1
+        if self.nodes & 255 == 0 and time.time() > self.deadline:
+            raise SearchTimeout()
+
+def get_board_hash(state, player, salt=0):
+    # 增量維護的 Zobrist 鍵再加上輪到誰；salt 區分版面、規則與評估權重 (見 get_search_salt)
+    return (state.hash ^ ZOBRIST_SIDE if player == 2 else state.hash) ^ salt
+
+def get_search_salt(topology, is_score_again, weights):
+    # Zobrist 鍵只由線段 ID 組成，不同權重、規則或線段 ID 相同的不同版面會得到同一個鍵，
+    # 混入這個 salt 後各自的分數在同一張置換表裡互不干擾 (AI 對戰時兩邊權重不同也能各自沿用)
+    return zobrist_key(f"{topology.fingerprint}|{is_score_again}|{json.dumps(weights, sort_keys=True)}")
+
+def minimax(state, topology, depth, is_maximizing, alpha, beta, weights, is_score_again, search, ply=0):
+    search.check_time()
+    board_hash = get_board_hash(state, 2 if is_maximizing else 1, search.salt)
+    # 界限旗標要相對於呼叫時的視窗判斷，先記下置換表收窄之前的 alpha/beta
+    alpha_orig = alpha
+    beta_orig = beta
+    tt_move = -1
+    entry = transposition_table.probe(board_hash)
+    if entry is not None:
+        entry_depth, entry_score, entry_flag, tt_move = entry
+        if entry_depth >= depth:
+            if entry_flag == 0: return entry_score
+            if entry_flag == 1: alpha = max(alpha, entry_score)
+            if entry_flag == 2: beta = min(beta, entry_score)
+            if alpha >= beta: return entry_score
+
+    if depth <= 0 or is_terminal(state, topology):
+        return evaluate_board(state, weights)
+    
+    player = 2 if is_maximizing else 1
+    if is_score_again:
+        # 得分後再走一步：以整回合 (macro-move) 分支，每回合只扣一層深度
+        turns = generate_macro_moves(state, topology, player, search, ply=ply)
+    else:
+        # 先依優先級，同一優先級內依 killer 與 history 排序
+        all_moves = find_all_valid_moves(state, topology, player)
+        turns = [(move_id,) for move_id in get_ordered_moves(all_moves, state, topology, search.history, player, ply)]
+    if not turns:
+        return evaluate_board(state, weights)
+    # 走法串列的順序會隨 killer/history 改變，置換表只記最佳回合的最後一步 (候選步編號)，
+    # 在這次的串列裡找到以它結束的回合排到最前面
+    turn_indices = list(range(len(turns)))
+    if tt_move >= 0:
+        for turn_index, turn in enumerate(turns):
+            if turn[-1] == tt_move:
+                turn_indices.remove(turn_index)
+                turn_indices.insert(0, turn_index)
+                break
+    move_masks = topology.move_masks
     
     best_score = -math.inf if is_maximizing else math.inf
+    best_turn = turn_indices[0]
+    search.history.nodes += 1
     
+    # 這一回合的得分 (±5000/格) 是在子節點之後才加上的，子節點的視窗 (含零視窗) 都要先扣掉它，
+    # 否則剪枝會依賴搜尋順序、回傳的界限也不正確。得分後同一方繼續的情況已包在整回合裡
     if is_maximizing:
-        for move in ordered_moves:
-            sim = simulate_move(move, lines, triangles, 2)
-            if not sim: continue
-            
-            next_depth = depth - 1
-            next_maximizing = False
-            if is_score_again and sim['scoreGained'] > 0:
-                next_depth = depth 
-                next_maximizing = True
+        for turn_index in turn_indices:
+            undos = [make_move(state, move_masks[move_id], topology, 2) for move_id in turns[turn_index]]
+            gain = sum(undo[3].bit_count() for undo in undos) * 5000
             
-            val = minimax(sim['newLines'], sim['newTriangles'], dots_flat, next_depth, next_maximizing, alpha, beta, weights, req_len, is_score_again)
-            val += sim['scoreGained'] * 5000 
+            if turn_index == turn_indices[0]:
+                val = minimax(state, topology, depth - 1, False, alpha - gain, beta - gain, weights, is_score_again, search, ply + 1)
+            else:
+                # PVS：其餘回合先用零視窗試探能否超過 alpha，超過 (且未超過 beta) 才用完整視窗重搜
+                val = minimax(state, topology, depth - 1, False, alpha - gain, alpha - gain + 1, weights, is_score_again, search, ply + 1)
+                if alpha - gain < val < beta - gain:
+                    val = minimax(state, topology, depth - 1, False, alpha - gain, beta - gain, weights, is_score_again, search, ply + 1)
+            for undo in reversed(undos): unmake_move(state, undo, topology)
+            val += gain
             
-            best_score = max(best_score, val)
+            if val > best_score:
+                best_score = val
+                best_turn = turn_index
             alpha = max(alpha, val)
-            if beta <= alpha: break
+            if beta <= alpha:
+                # 以結束這一回合的那一步記錄 killer/history
+                search.history.record_cutoff(turns[turn_index][-1], player, depth, ply, turn_index == turn_indices[0])
+                break
     else:
-        for move in ordered_moves:
-            sim = simulate_move(move, lines, triangles, 1)
-            if not sim: continue
-            
-            next_depth = depth - 1
-            next_maximizing = True
-            if is_score_again and sim['scoreGained'] > 0:
-                next_depth = depth
-                next_maximizing = False
+        for turn_index in turn_indices:
+            undos = [make_move(state, move_masks[move_id], topology, 1) for move_id in turns[turn_index]]
+            gain = sum(undo[3].bit_count() for undo in undos) * 5000
             
-            val = minimax(sim['newLines'], sim['newTriangles'], dots_flat, next_depth, next_maximizing, alpha, beta, weights, req_len, is_score_again)
-            val -= sim['scoreGained'] * 5000
+            if turn_index == turn_indices[0]:
+                val = minimax(state, topology, depth - 1, True, alpha + gain, beta + gain, weights, is_score_again, search, ply + 1)
+            else:
+                val = minimax(state, topology, depth - 1, True, beta + gain - 1, beta + gain, weights, is_score_again, search, ply + 1)
+                if alpha + gain < val < beta + gain:
+                    val = minimax(state, topology, depth - 1, True, alpha + gain, beta + gain, weights, is_score_again, search, ply + 1)
+            for undo in reversed(undos): unmake_move(state, undo, topology)
+            val -= gain
             
-            best_score = min(best_score, val)
+            if val < best_score:
+                best_score = val
+                best_turn = turn_index
             beta = min(beta, val)
-            if beta <= alpha: break
+            if beta <= alpha:
+                # 以結束這一回合的那一步記錄 killer/history
+                search.history.record_cutoff(turns[turn_index][-1], player, depth, ply, turn_index == turn_indices[0])
+                break
             
     flag = 0
-    if best_score <= alpha: flag = 2
-    elif best_score >= beta: flag = 1
+    if best_score <= alpha_orig: flag = 2
+    elif best_score >= beta_orig: flag = 1
     
-    transposition_table[board_hash] = {'depth': depth, 'score': best_score, 'flag': flag}
+    transposition_table.store(board_hash, depth, best_score, flag, turns[best_turn][-1])
     return best_score
 
 # ==========================================
 # 3. 伺服器路由
 # ==========================================
 
+def get_layout_fingerprint(dots_rows, lines, triangles, required_length, allow_shorter, is_3d):
+    # 版面指紋：點座標、線段 ID (順序決定線段編號)、三角形的邊與規則
+    # 3D 的 x/y 會隨旋轉改變且不參與幾何，不列入指紋
+    parts = []
+    for row in dots_rows:
+        for d in row:
+            if is_3d: parts.append(f"{d['r']},{d['c']}")
+            else: parts.append(f"{d['r']},{d['c']}:{d['x']!r},{d['y']!r}")
+    parts.append('|'.join(lines.keys()))
+    for tri in triangles:
+        parts.append(','.join(tri['lineKeys']))
+    parts.append(f"{required_length}:{allow_shorter}:{is_3d}")
+    return hashlib.blake2b(';'.join(parts).encode(), digest_size=16).hexdigest()
+
+def estimate_topology_bytes(topology):
+    # 粗估一份拓樸佔用的記憶體 (主要是候選步、遮罩與 Zobrist 表)
+    size = 0
+    for move in topology.moves:
+        size += sys.getsizeof(move) + sys.getsizeof(move.segs) + sys.getsizeof(move.mask)
+    for seg in topology.segments:
+        size += sys.getsizeof(seg) + sys.getsizeof(seg.key)
+    for table in (topology.move_masks, topology.seg_move_masks, topology.tri_masks,
+                  topology.seg_tri_masks, topology.tri_segs, topology.seg_tris):
+        size += sys.getsizeof(table) + sum(sys.getsizeof(x) for x in table)
+    size += sum(sys.getsizeof(keys) + 9 * 32 for keys in topology.zobrist_lines)
+    size += sum(sys.getsizeof(keys) + 3 * 32 for keys in topology.zobrist_tris)
+    size += sum(sys.getsizeof(d) for d in topology.dots)
+    if topology._rays is not None:
+        for dot_rays in topology._rays:
+            for ray in dot_rays:
+                size += sys.getsizeof(ray) + sum(sys.getsizeof(step) + sys.getsizeof(step[1]) for step in ray)
+    return size
+
+class TopologyCache:
+    # 跨請求共用的已編譯拓樸 (LRU)：同一局、批次對戰都會反覆送同一個版面，
+    # 命中時每個請求只需解碼可變的已畫/歸屬狀態
+    def __init__(self, max_mb=64):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, dots_rows, lines, triangles, required_length=1, allow_shorter=False, is_3d=False):
+        key = get_layout_fingerprint(dots_rows, lines, triangles, required_length, allow_shorter, is_3d)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        
+        self.misses += 1
+        topology = BoardTopology(dots_rows, lines, triangles, required_length, allow_shorter, is_3d)
+        # 版面指紋也用來區分置換表裡不同版面的局面
+        topology.fingerprint = key
+        size = estimate_topology_bytes(topology)
+        self.entries[key] = (topology, size)
+        self.total_bytes += size
+        # 超過記憶體上限時從最久沒用的開始淘汰 (至少保留剛放入的這份)
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, old_size) = self.entries.popitem(last=False)
+            self.total_bytes -= old_size
+        return topology
+
+topology_cache = TopologyCache()
+
+def move_to_json(move, topology, dots_rows):
+    # 引擎內部的 Move → 前端的 bestMove 格式 (dot1/dot2 為請求中原本的點物件)
+    dot1 = topology.dots[move.dot1]
+    dot2 = topology.dots[move.dot2]
+    return {
+        'dot1': dots_rows[dot1.r][dot1.c],
+        'dot2': dots_rows[dot2.r][dot2.c],
+        'segmentIds': [topology.seg_keys[seg] for seg in move.segs]
+    }
+
+def search_root(state, topology, ordered_moves, depth, player, weights, is_score_again, search, alpha=-math.inf, beta=math.inf):
+    # 根節點：逐一試走第一步並回傳 [(分數, 步)]，得分後再走一步時同一方以相同深度繼續。
+    # 第一步用 (alpha, beta) 完整視窗，其餘先以零視窗試探能否達到目前最佳 (差 0.1 內視為同分)，
+    # 達到才重搜出精確分數；沒達到的步回傳的是界限，不會被選為最佳
+    move_masks = topology.move_masks
+    is_maximizing = (player == 2)
+    candidates = []
+    best_val = None
+    for move_id in ordered_moves:
+        undo = make_move(state, move_masks[move_id], topology, player)
+        if not undo: continue
+        score_gained = undo[3].bit_count()
+        
+        next_maximizing = is_maximizing if (is_score_again and score_gained > 0) else (not is_maximizing)
+        next_depth = depth if (is_score_again and score_gained > 0) else depth - 1
+        # 總分 = 子節點分數 + shift，子節點的視窗都要扣掉 shift
+        shift = score_gained * 5000 if is_maximizing else -score_gained * 5000
+        
+        if best_val is None:
+            total_val = minimax(state, topology, next_depth, next_maximizing, alpha - shift, beta - shift, weights, is_score_again, search, 1) + shift
+        elif is_maximizing:
+            bound = max(alpha, best_val - 0.1)
+            total_val = minimax(state, topology, next_depth, next_maximizing, bound - shift, bound - shift + 1, weights, is_score_again, search, 1) + shift
+            if bound < total_val < beta:
+                total_val = minimax(state, topology, next_depth, next_maximizing, bound - shift, beta - shift, weights, is_score_again, search, 1) + shift
+        else:
+            bound = min(beta, best_val + 0.1)
+            total_val = minimax(state, topology, next_depth, next_maximizing, bound - shift - 1, bound - shift, weights, is_score_again, search, 1) + shift
+            if alpha < total_val < bound:
+                total_val = minimax(state, topology, next_depth, next_maximizing, alpha - shift, bound - shift, weights, is_score_again, search, 1) + shift
+        unmake_move(state, undo, topology)
+        
+        if best_val is None or (total_val > best_val if is_maximizing else total_val < best_val):
+            best_val = total_val
+        candidates.append((total_val, move_id))
+    return candidates
+
 @app.route('/get_move', methods=['POST'])
 def get_move():
-    global transposition_table
     try:
         data = request.json
         game_state = data['gameState']
         lines = game_state['lines']
         triangles = game_state['triangles']
         dots_rows = game_state['dots']
-        dots_flat = [d for row in dots_rows for d in row]
         player = game_state['player']
         req_len = game_state['requiredLineLength']
+        allow_shorter = game_state.get('allowShorterLines', False)
+        is_3d = game_state.get('is3DMode', False)
         is_score_again = game_state['isScoreAndGoAgain']
         weights = data.get('weights')
         
         print(f"收到請求: P{player} (V8.0 平衡版)")
         
-        if len(transposition_table) > 200000:
-            transposition_table.clear()
-
         start_time = time.time()
         
         empty_lines = sum(1 for k, v in lines.items() if not v['drawn'])
         
-        # 目標深度設定
-        target_depth = 3
-        if empty_lines < 30: target_depth = 4
-        if empty_lines < 15: target_depth = 5 
-        if empty_lines < 10: target_depth = 7 
-        if req_len == 1 and target_depth > 4: target_depth = 4
+        # 深度由時間預算決定：迭代加深一直加深到期限為止。每回合至少畫一條新線段，
+        # 深度達到剩餘線段數時整盤已搜到終局，再加深也不會改變結果；MAX_PLY 只是安全上限
+        target_depth = min(empty_lines, MoveHistory.MAX_PLY)
         
-        print(f"  - 剩餘線段: {empty_lines}, 目標深度: {target_depth}")
+        print(f"  - 剩餘線段: {empty_lines}, 深度上限: {target_depth}")
         
-        all_moves = find_all_valid_moves(lines, dots_flat, req_len)
+        topology = topology_cache.get(dots_rows, lines, triangles, req_len, allow_shorter, is_3d)
+        print(f"  - 拓樸快取: 命中 {topology_cache.hits} / 未命中 {topology_cache.misses}, "
+              f"{len(topology_cache.entries)} 份 {topology_cache.total_bytes / 1048576:.1f}MB")
+        transposition_table.new_search()
+        state = encode_state(lines, triangles, topology)
+        move_masks = topology.move_masks
+        all_moves = find_all_valid_moves(state, topology, player)
         
         # [關鍵修正] 在排序前先隨機洗牌，解決開局只下上面的問題
         random.shuffle(all_moves)
         
-        ordered_moves = get_ordered_moves(all_moves, lines, triangles)
+        ordered_moves = get_ordered_moves(all_moves, state, topology)
         
         if not ordered_moves:
             return jsonify({'bestMove': None})
 
+        is_maximizing = (player == 2)
         best_move = ordered_moves[0]
-        current_best_val = -math.inf if player == 2 else math.inf
-        
+        current_best_val = -math.inf if is_maximizing else math.inf
         # 紀錄所有最佳分數的步數，避免排序後永遠取第一個
         candidates = []
-
-        for move in ordered_moves:
-            sim = simulate_move(move, lines, triangles, player)
-            if not sim: continue
-            
-            is_maximizing = (player == 2)
-            next_maximizing = is_maximizing if (is_score_again and sim['scoreGained'] > 0) else (not is_maximizing)
-            next_depth = target_depth if (is_score_again and sim['scoreGained'] > 0) else target_depth - 1
-            
-            val = minimax(sim['newLines'], sim['newTriangles'], dots_flat, next_depth, next_maximizing, -math.inf, math.inf, weights, req_len, is_score_again)
-            
-            immediate = sim['scoreGained'] * 5000
-            total_val = (val + immediate) if is_maximizing else (val - immediate)
-            
-            candidates.append((total_val, move))
-            
-            if is_maximizing:
-                if total_val > current_best_val:
-                    current_best_val = total_val
-                    best_move = move
-            else:
-                if total_val < current_best_val:
-                    current_best_val = total_val
-                    best_move = move
+        reached_depth = 0
+        
+        # 迭代加深：由淺到深逐層搜尋，時間到就採用最後一輪完整搜完的結果
+        # 第一輪也受期限限制；連深度 1 都沒搜完時退回優先級排序的第一步 (回報深度 0)
+        time_limit = data.get('timeLimit', DEFAULT_TIME_LIMIT)
+        root_snapshot = snapshot_state(state)
+        search = SearchContext(start_time + time_limit, MoveHistory(topology), get_search_salt(topology, is_score_again, weights))
+        for depth in range(1, target_depth + 1):
+            # 上一輪的最佳步排到最前面，其餘維持原本的優先序
+            if depth > 1:
+                ordered_moves.remove(best_move)
+                ordered_moves.insert(0, best_move)
+            try:
+                # 渴望視窗：以上一輪的分數為中心只開一個小視窗，落在視窗外就往失敗的那一側放寬後重搜
+                window = ASPIRATION_WINDOW
+                alpha, beta = -math.inf, math.inf
+                if depth > 1: alpha, beta = current_best_val - window, current_best_val + window
+                while True:
+                    iteration = search_root(state, topology, ordered_moves, depth, player, weights, is_score_again, search, alpha, beta)
+                    value = max(iteration)[0] if is_maximizing else min(iteration)[0]
+                    if alpha < value < beta: break
+                    window *= 8
+                    if value <= alpha: alpha = value - window if window <= ASPIRATION_MAX_WINDOW else -math.inf
+                    else: beta = value + window if window <= ASPIRATION_MAX_WINDOW else math.inf
+            except SearchTimeout:
+                # 中斷時盤面停在搜尋中途，由快照重建
+                state = restore_state(root_snapshot, topology)
+                print(f"  - 時間到，深度 {depth} 未完成")
+                break
+            candidates = iteration
+            reached_depth = depth
+            if is_maximizing: current_best_val, best_move = max(candidates, key=lambda x: x[0])
+            else: current_best_val, best_move = min(candidates, key=lambda x: x[0])
+            if time.time() - start_time > time_limit: break
 
         # [二次隨機] 如果有多個分數相同的最佳步，隨機選一個
         # 允許誤差範圍 (浮點數安全)
@@ -374,18 +1171,21 @@ def get_move():
             print(f"  - 從 {len(best_candidates)} 個最佳步中隨機選擇")
 
         # 防呆
-        if best_move:
-             if not simulate_move(best_move, lines, triangles, player):
-                 print("警告：最佳步無效，強制選擇第一合法步")
-                 for move in ordered_moves:
-                     if simulate_move(move, lines, triangles, player):
-                         best_move = move
-                         break
+        if not move_masks[best_move] & ~state.drawn:
+            print("警告：最佳步無效，強制選擇第一合法步")
+            for move_id in ordered_moves:
+                if move_masks[move_id] & ~state.drawn:
+                    best_move = move_id
+                    break
 
         duration = time.time() - start_time
-        print(f"運算完成: 深度 {target_depth}, 耗時 {duration:.2f}s")
+        print(f"運算完成: 深度 {reached_depth}/{target_depth}, 耗時 {duration:.2f}s, 置換表 {len(transposition_table)} 筆")
+        history = search.history
+        if history.nodes:
+            print(f"  - 剪枝: {history.cutoffs}/{history.nodes} 節點 ({history.cutoffs / history.nodes:.0%}), "
+                  f"第一步就剪枝 {history.first_cutoffs / max(history.cutoffs, 1):.0%}")
         
-        return jsonify({'bestMove': best_move})
+        return jsonify({'bestMove': move_to_json(topology.moves[best_move], topology, dots_rows), 'depth': reached_depth})
         
     except Exception as e:
         error_msg = str(e)
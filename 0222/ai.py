@@ -39,53 +39,51 @@ def find_intermediate_dots(dotA, dotB, all_dots_flat):
     intermediate.sort(key=lambda d: (d['x'], d['y']))
     return intermediate
 
-def is_valid_line(dotA, dotB, current_lines, all_dots_flat, required_length=1):
-    if not dotA or not dotB: return False
-    dx = dotB['x'] - dotA['x']
-    dy = dotB['y'] - dotA['y']
-    
-    # 角度檢查 (0, 60, 120, 180)
-    if abs(dx) > 0.1 or abs(dy) > 0.1:
-        angle = math.atan2(dy, dx) * 180 / math.pi
-        abs_angle = abs(angle)
-        valid = False
-        for v in [0, 60, 120, 180]:
-            if abs(abs_angle - v) < 2.5:
-                valid = True
-                break
-        if not valid: return False
-
-    dots_on_line = find_intermediate_dots(dotA, dotB, all_dots_flat)
-    segment_ids = []
-    for i in range(len(dots_on_line) - 1):
-        segment_ids.append(get_line_id(dots_on_line[i], dots_on_line[i+1]))
-    
-    if len(segment_ids) != required_length: return False
-    
-    has_undrawn = False
-    for sid in segment_ids:
-        if sid not in current_lines: return False
-        if not current_lines[sid]['drawn']:
-            has_undrawn = True
-            
-    return has_undrawn
-
-def find_all_valid_moves(lines, dots_flat, required_length=1):
-    moves = []
-    count = len(dots_flat)
-    for i in range(count):
-        for j in range(i + 1, count):
-            dotA = dots_flat[i]
-            dotB = dots_flat[j]
-            if is_valid_line(dotA, dotB, lines, dots_flat, required_length):
+class MoveTable:
+    # 棋盤編譯時只建一次：線段 ID 字串轉成連續整數 (line_ids[i] 為第 i 條線段的 ID)，
+    # 幾何上成立的候選步以整數編號，move_segs[m] 為候選步 m 的線段整數 tuple。
+    # 產生合法步時只需檢查線段是否已畫，不再逐點對重做幾何與 get_line_id 字串組合。
+    # 整數編號只用在 legal_moves；simulate_move 與 EvalAccumulator 仍以線段 ID 字串為鍵
+    # 連線規則 (角度 0/60/120/180、恰好 required_length 段、線段存在) 只在這裡檢查
+    def __init__(self, lines, dots_flat, required_length=1):
+        self.line_ids = list(lines.keys())
+        self.line_index = {lid: i for i, lid in enumerate(self.line_ids)}
+        self.moves = []
+        self.move_segs = []
+        count = len(dots_flat)
+        for i in range(count):
+            for j in range(i + 1, count):
+                dotA = dots_flat[i]
+                dotB = dots_flat[j]
+                dx = dotB['x'] - dotA['x']
+                dy = dotB['y'] - dotA['y']
+                if abs(dx) > 0.1 or abs(dy) > 0.1:
+                    abs_angle = abs(math.atan2(dy, dx) * 180 / math.pi)
+                    if not any(abs(abs_angle - v) < 2.5 for v in [0, 60, 120, 180]): continue
+                
                 dots_on_line = find_intermediate_dots(dotA, dotB, dots_flat)
                 seg_ids = [get_line_id(dots_on_line[k], dots_on_line[k+1]) for k in range(len(dots_on_line)-1)]
-                moves.append({
+                if len(seg_ids) != required_length: continue
+                if any(sid not in self.line_index for sid in seg_ids): continue
+                # 對外 (simulate_move / 輸出) 仍使用原本的 dict 格式，只在這裡建立一次
+                self.moves.append({
                     'dot1': dotA,
                     'dot2': dotB,
                     'segmentIds': seg_ids,
                     'id': f"Move({dotA['r']},{dotA['c']}->{dotB['r']},{dotB['c']})"
                 })
+                self.move_segs.append(tuple(self.line_index[sid] for sid in seg_ids))
+
+    def legal_moves(self, lines):
+        # 回傳至少有一段尚未畫過的候選步編號
+        drawn = [lines[lid]['drawn'] for lid in self.line_ids]
+        return [m for m, segs in enumerate(self.move_segs) if not all(drawn[s] for s in segs)]
+
+def find_all_valid_moves(lines, dots_flat, required_length=1, table=None):
+    # table 為該棋盤預先編譯的 MoveTable；未提供時當場建立 (結果相同)
+    if table is None:
+        table = MoveTable(lines, dots_flat, required_length)
+    moves = [table.moves[m] for m in table.legal_moves(lines)]
     random.shuffle(moves) # 隨機打亂避免僵化
     return moves
 
@@ -126,96 +124,185 @@ def simulate_move(move, lines, triangles, player):
 # 2. 強化版評估函數 (加入必勝法邏輯)
 # ==========================================
 
-def evaluate_board_enhanced(lines, triangles, weights):
-    w = weights
-    score_scale = w.get('scoreScale', 200)
-    p1_threat_val = w.get('p1ThreatVal', 30)
-    p2_threat_val = w.get('p2ThreatVal', -30)
-    # 必勝法關鍵權重：雙重佈局
-    p1_double_val = w.get('p1DoubleVal', 100)
-    p2_double_val = w.get('p2DoubleVal', -100)
-    
-    p2_score = 0
-    p1_score = 0
-    p1_threats = 0
-    p2_threats = 0
-    
-    # 用於偵測 Double Setup: 記錄每個 "缺邊" 被誰威脅
-    # key: missing_line_id, value: list of players who threaten it
-    threat_map = {} 
+class EvalAccumulator:
+    # 評估 = (P2 得分 - P1 得分) × scoreScale + 威脅 (差一邊、邊數較多的一方) + 雙重佈局 (Double Setup：
+    # 同一條缺邊被同一方威脅兩次以上，必勝法的關鍵權重)。
+    # 隨著下子/悔棋只重算相鄰三角形，葉節點評估只需讀取計數器
+    def __init__(self, lines, triangles, line_tris=None):
+        # line_tris 可直接沿用 create_board 產生的線段 → 三角形索引
+        if line_tris is None:
+            line_tris = {}
+            for i, tri in enumerate(triangles):
+                for key in tri['lineKeys']:
+                    line_tris.setdefault(key, []).append(i)
+        self.line_tris = line_tris
+        
+        self.p1_score = 0
+        self.p2_score = 0
+        self.p1_threats = 0
+        self.p2_threats = 0
+        self.p1_double_setups = 0
+        self.p2_double_setups = 0
+        # 每條缺邊被 P1/P2 威脅的次數: key -> [p1_count, p2_count]
+        self.missing_threats = {}
+        # 每個三角形目前貢獻的評估項 (filled_player, threat_owner, missing_key)
+        self.tri_terms = [(0, 0, None)] * len(triangles)
+        # 排序用的「已畫鄰邊」計數: key -> [會完成的三角形數, 會送出威脅的三角形數]
+        self.line_order = {}
+        # 每個三角形目前貢獻的排序項 ((key, 0 或 1), ...)
+        self.tri_order = [()] * len(triangles)
+        
+        for i, tri in enumerate(triangles):
+            self._set_terms(i, self._compute_terms(lines, tri))
+            self._set_order(i, self._compute_order(lines, tri))
 
-    for tri in triangles:
+    def _compute_terms(self, lines, tri):
         if tri['filled']:
-            if tri['player'] == 2: p2_score += 1
-            elif tri['player'] == 1: p1_score += 1
-        else:
-            drawn_count = 0
-            missing_key = None
-            owners = []
-            
-            for key in tri['lineKeys']:
-                l = lines.get(key)
-                if l and l['drawn']:
-                    drawn_count += 1
-                    owners.append(l['player'])
-                    if l.get('sharedBy', 0) != 0: owners.append(l['sharedBy'])
-                else:
-                    missing_key = key
-            
-            if drawn_count == 2:
-                # 判斷是誰的威脅 (擁有較多邊的人)
-                p1_cnt = owners.count(1)
-                p2_cnt = owners.count(2)
-                threat_owner = 0
-                
-                if p1_cnt > p2_cnt: 
-                    p1_threats += 1
-                    threat_owner = 1
-                elif p2_cnt > p1_cnt: 
-                    p2_threats += 1
-                    threat_owner = 2
-                
-                if threat_owner != 0 and missing_key:
-                    if missing_key not in threat_map:
-                        threat_map[missing_key] = []
-                    threat_map[missing_key].append(threat_owner)
-
-    # 計算 Double Setups (同一條缺邊被威脅兩次以上)
-    p1_double_setups = 0
-    p2_double_setups = 0
-    
-    for missing_key, owners in threat_map.items():
-        if len(owners) >= 2:
-            # 簡單判定：如果這條邊的威脅者都是同一人，則構成該人的 Double Setup
-            if all(o == 1 for o in owners):
-                p1_double_setups += 1
-            elif all(o == 2 for o in owners):
-                p2_double_setups += 1
+            return (tri['player'], 0, None)
+        drawn_count = 0
+        missing_key = None
+        owners = []
+        for key in tri['lineKeys']:
+            l = lines.get(key)
+            if l and l['drawn']:
+                drawn_count += 1
+                owners.append(l['player'])
+                if l.get('sharedBy', 0) != 0: owners.append(l['sharedBy'])
+            else:
+                missing_key = key
+        
+        threat_owner = 0
+        if drawn_count == 2:
+            p1_cnt = owners.count(1)
+            p2_cnt = owners.count(2)
+            if p1_cnt > p2_cnt: threat_owner = 1
+            elif p2_cnt > p1_cnt: threat_owner = 2
+        return (0, threat_owner, missing_key)
 
-    # 分數計算：必勝法策略會極大化 Double Setup 的價值
-    total_score = (p2_score - p1_score) * score_scale + \
-                  (p1_threats * p1_threat_val + p2_threats * p2_threat_val) + \
-                  (p1_double_setups * p1_double_val + p2_double_setups * p2_double_val)
+    def _compute_order(self, lines, tri):
+        # 未完成三角形的每條邊：其餘邊全畫 → 畫它就完成 (0)；其餘邊差一條 → 畫它會送出威脅 (1)
+        if tri['filled']:
+            return ()
+        keys = tri['lineKeys']
+        drawn = [bool(lines.get(key) and lines[key]['drawn']) for key in keys]
+        count = sum(drawn)
+        if count < len(keys) - 2:
+            return ()
+        order = []
+        for key, is_drawn in zip(keys, drawn):
+            others = count - is_drawn
+            if others == len(keys) - 1: order.append((key, 0))
+            elif others == len(keys) - 2: order.append((key, 1))
+        return tuple(order)
+
+    def _set_order(self, i, order):
+        old = self.tri_order[i]
+        if old == order: return
+        for key, kind in old:
+            self.line_order[key][kind] -= 1
+        for key, kind in order:
+            self.line_order.setdefault(key, [0, 0])[kind] += 1
+        self.tri_order[i] = order
+
+    def _double_owner(self, missing_key):
+        counts = self.missing_threats.get(missing_key)
+        if not counts: return 0
+        if counts[0] >= 2 and counts[1] == 0: return 1
+        if counts[1] >= 2 and counts[0] == 0: return 2
+        return 0
+
+    def _add_terms(self, terms, sign):
+        filled_player, threat_owner, missing_key = terms
+        if filled_player == 1: self.p1_score += sign
+        elif filled_player == 2: self.p2_score += sign
+        if threat_owner == 1: self.p1_threats += sign
+        elif threat_owner == 2: self.p2_threats += sign
+        
+        if threat_owner != 0 and missing_key:
+            before = self._double_owner(missing_key)
+            counts = self.missing_threats.setdefault(missing_key, [0, 0])
+            counts[threat_owner - 1] += sign
+            after = self._double_owner(missing_key)
+            if before != after:
+                if before == 1: self.p1_double_setups -= 1
+                elif before == 2: self.p2_double_setups -= 1
+                if after == 1: self.p1_double_setups += 1
+                elif after == 2: self.p2_double_setups += 1
 
-    return total_score
+    def _set_terms(self, i, terms):
+        old = self.tri_terms[i]
+        if old == terms: return
+        self._add_terms(old, -1)
+        self._add_terms(terms, 1)
+        self.tri_terms[i] = terms
+
+    def apply(self, segment_ids, lines, triangles):
+        # lines/triangles 為下子後的盤面；回傳 revert 用的紀錄
+        record = []
+        seen = set()
+        for key in segment_ids:
+            for i in self.line_tris.get(key, ()):
+                if i in seen: continue
+                seen.add(i)
+                record.append((i, self.tri_terms[i], self.tri_order[i]))
+                self._set_terms(i, self._compute_terms(lines, triangles[i]))
+                self._set_order(i, self._compute_order(lines, triangles[i]))
+        return record
+
+    def revert(self, record):
+        for i, terms, order in reversed(record):
+            self._set_terms(i, terms)
+            self._set_order(i, order)
+
+    def is_full(self):
+        return self.p1_score + self.p2_score == len(self.tri_terms)
+
+    def evaluate(self, weights):
+        w = weights
+        score_scale = w.get('scoreScale', 200)
+        p1_threat_val = w.get('p1ThreatVal', 30)
+        p2_threat_val = w.get('p2ThreatVal', -30)
+        p1_double_val = w.get('p1DoubleVal', 100)
+        p2_double_val = w.get('p2DoubleVal', -100)
+        
+        return (self.p2_score - self.p1_score) * score_scale + \
+               (self.p1_threats * p1_threat_val + self.p2_threats * p2_threat_val) + \
+               (self.p1_double_setups * p1_double_val + self.p2_double_setups * p2_double_val)
+
+def get_move_order_class(segment_ids, acc):
+    # 由這步自己的線段讀取「已畫鄰邊」計數：會完成三角形 (第三邊) 100、
+    # 會留下只差一邊的三角形 -10、其他 0 (與伺服器的 get_move_order_class 相同)
+    # 對戰實驗的 minimax 不使用它 (候選步維持隨機順序)，只供需要排序的呼叫端使用
+    is_bad_move = False
+    for key in segment_ids:
+        counts = acc.line_order.get(key)
+        if not counts: continue
+        if counts[0]: return 100
+        if counts[1]: is_bad_move = True
+    return -10 if is_bad_move else 0
 
 # ==========================================
 # 3. AI 代理人
 # ==========================================
 
-def minimax(lines, triangles, dots_flat, depth, is_maximizing, alpha, beta, weights, req_len, is_score_again):
+def minimax(lines, triangles, dots_flat, depth, is_maximizing, alpha, beta, weights, req_len, is_score_again, acc, table=None):
     # 簡化版 Minimax，移除置換表以保持獨立執行
-    if depth <= 0 or all(t['filled'] for t in triangles):
-        return evaluate_board_enhanced(lines, triangles, weights)
+    # acc 為與 lines/triangles 同步的 EvalAccumulator，葉節點直接讀取
+    # table 為 get_best_move 建好的 MoveTable，整棵搜尋樹共用
+    if depth <= 0 or acc.is_full():
+        return acc.evaluate(weights)
     
-    all_moves = find_all_valid_moves(lines, dots_flat, req_len)
+    if table is None:
+        table = MoveTable(lines, dots_flat, req_len)
+    all_moves = find_all_valid_moves(lines, dots_flat, req_len, table)
     if not all_moves:
-        return evaluate_board_enhanced(lines, triangles, weights)
+        return acc.evaluate(weights)
     
     # 簡易排序：優先考慮可能得分的步
     # (在完整版中會有更複雜的排序，這裡保持隨機性以測試策略穩健度)
     
     best_score = -math.inf if is_maximizing else math.inf
+    is_first = True
     
     for move in all_moves[:8]: # 限制分支因子以加速演示
         sim = simulate_move(move, lines, triangles, 2 if is_maximizing else 1)
@@ -232,15 +319,28 @@ def minimax(lines, triangles, dots_flat, depth, is_maximizing, alpha, beta, weig
         else:
             next_maximizing = not is_maximizing
         
-        val = minimax(sim['newLines'], sim['newTriangles'], dots_flat, next_depth, next_maximizing, alpha, beta, weights, req_len, is_score_again)
+        # 立即得分的獎勵是在子節點之後才加上的，子節點的視窗要先扣掉它
+        shift = sim['scoreGained'] * 5000 if is_maximizing else -sim['scoreGained'] * 5000
+        
+        record = acc.apply(move['segmentIds'], sim['newLines'], sim['newTriangles'])
+        child_args = (sim['newLines'], sim['newTriangles'], dots_flat, next_depth, next_maximizing)
+        if is_first:
+            val = minimax(*child_args, alpha - shift, beta - shift, weights, req_len, is_score_again, acc, table)
+        else:
+            # PVS：其餘步先用零視窗試探能否優於目前最佳，成功 (且未超出視窗) 才用完整視窗重搜
+            if is_maximizing: val = minimax(*child_args, alpha - shift, alpha - shift + 1, weights, req_len, is_score_again, acc, table)
+            else: val = minimax(*child_args, beta - shift - 1, beta - shift, weights, req_len, is_score_again, acc, table)
+            if alpha - shift < val < beta - shift:
+                val = minimax(*child_args, alpha - shift, beta - shift, weights, req_len, is_score_again, acc, table)
+        acc.revert(record)
+        is_first = False
         
         # 加上立即得分的獎勵
+        val += shift
         if is_maximizing:
-            val += sim['scoreGained'] * 5000
             best_score = max(best_score, val)
             alpha = max(alpha, val)
         else:
-            val -= sim['scoreGained'] * 5000
             best_score = min(best_score, val)
             beta = min(beta, val)
             
@@ -248,12 +348,15 @@ def minimax(lines, triangles, dots_flat, depth, is_maximizing, alpha, beta, weig
             
     return best_score
 
-def get_best_move(lines, triangles, dots_flat, player, weights, depth=2):
+def get_best_move(lines, triangles, dots_flat, player, weights, depth=2, line_tris=None, table=None):
     is_maximizing = (player == 2)
     best_move = None
     best_val = -math.inf if is_maximizing else math.inf
     
-    all_moves = find_all_valid_moves(lines, dots_flat, required_length=1)
+    if table is None:
+        table = MoveTable(lines, dots_flat, required_length=1)
+    all_moves = find_all_valid_moves(lines, dots_flat, 1, table)
+    acc = EvalAccumulator(lines, triangles, line_tris)
     
     print(f"  AI (P{player}) 思考中... (深度 {depth}, 權重策略: {'必勝法' if weights['p1DoubleVal'] > 50 else '普通'})")
 
@@ -263,12 +366,22 @@ def get_best_move(lines, triangles, dots_flat, player, weights, depth=2):
         
         next_maximizing = is_maximizing if (sim['scoreGained'] > 0) else (not is_maximizing)
         
-        # 呼叫 Minimax
-        val = minimax(sim['newLines'], sim['newTriangles'], dots_flat, depth-1, next_maximizing, -math.inf, math.inf, weights, 1, True)
-        
-        # 加上立即得分
+        # 呼叫 Minimax：第一步完整視窗，其餘步以零視窗只問「是否嚴格優於目前最佳」，是才重搜精確分數
         immediate = sim['scoreGained'] * 5000
-        total_val = (val + immediate) if is_maximizing else (val - immediate)
+        shift = immediate if is_maximizing else -immediate
+        record = acc.apply(move['segmentIds'], sim['newLines'], sim['newTriangles'])
+        child_args = (sim['newLines'], sim['newTriangles'], dots_flat, depth-1, next_maximizing)
+        if best_move is None:
+            total_val = minimax(*child_args, -math.inf, math.inf, weights, 1, True, acc, table) + shift
+        elif is_maximizing:
+            total_val = minimax(*child_args, best_val - shift, best_val - shift + 1, weights, 1, True, acc, table) + shift
+            if total_val > best_val:
+                total_val = minimax(*child_args, best_val - shift, math.inf, weights, 1, True, acc, table) + shift
+        else:
+            total_val = minimax(*child_args, best_val - shift - 1, best_val - shift, weights, 1, True, acc, table) + shift
+            if total_val < best_val:
+                total_val = minimax(*child_args, -math.inf, best_val - shift, weights, 1, True, acc, table) + shift
+        acc.revert(record)
         
         if is_maximizing:
             if total_val > best_val:
@@ -331,26 +444,33 @@ def create_board(rows=[3, 4, 3]):
                     lid = get_line_id(d1, d_next)
                     lines[lid] = {'p1': d1, 'p2': d_next, 'drawn': False, 'player': 0, 'sharedBy': 0}
 
-    # 建立三角形
+    # 建立三角形：沿著線段的鄰接表找共同鄰點 (i < j < k)，
+    # 與線段數成線性；同時建立線段 → 三角形索引
+    index_of = {(d['r'], d['c']): i for i, d in enumerate(dots_flat)}
+    neighbors = [set() for _ in dots_flat]
+    for line in lines.values():
+        a = index_of[(line['p1']['r'], line['p1']['c'])]
+        b = index_of[(line['p2']['r'], line['p2']['c'])]
+        neighbors[a].add(b)
+        neighbors[b].add(a)
+    
     triangles = []
-    # 暴力搜尋所有可能的三角形 (三點兩兩相連)
-    count = len(dots_flat)
-    for i in range(count):
-        for j in range(i+1, count):
-            for k in range(j+1, count):
+    line_tris = {lid: [] for lid in lines}
+    for i in range(len(dots_flat)):
+        for j in sorted(n for n in neighbors[i] if n > i):
+            for k in sorted(n for n in neighbors[i] & neighbors[j] if n > j):
                 d1, d2, d3 = dots_flat[i], dots_flat[j], dots_flat[k]
-                l1 = get_line_id(d1, d2)
-                l2 = get_line_id(d1, d3)
-                l3 = get_line_id(d2, d3)
-                if l1 in lines and l2 in lines and l3 in lines:
-                    triangles.append({
-                        'lineKeys': [l1, l2, l3],
-                        'dots': [d1, d2, d3],
-                        'filled': False,
-                        'player': 0
-                    })
+                line_keys = [get_line_id(d1, d2), get_line_id(d1, d3), get_line_id(d2, d3)]
+                for key in line_keys:
+                    line_tris[key].append(len(triangles))
+                triangles.append({
+                    'lineKeys': line_keys,
+                    'dots': [d1, d2, d3],
+                    'filled': False,
+                    'player': 0
+                })
                     
-    return lines, triangles, dots_flat
+    return lines, triangles, dots_flat, line_tris
 
 # ==========================================
 # 5. 執行對戰
@@ -363,7 +483,9 @@ def run_battle():
     print("-" * 40)
     
     # 初始化 3-4-3 棋盤 (小型)
-    lines, triangles, dots_flat = create_board(rows=[3, 4, 3])
+    lines, triangles, dots_flat, line_tris = create_board(rows=[3, 4, 3])
+    # 候選步的幾何與線段編號整局只算一次
+    move_table = MoveTable(lines, dots_flat, required_length=1)
     
     # 設定權重
     # P1: 必勝法 (DoubleVal 極高)
@@ -392,7 +514,7 @@ def run_battle():
         # P1 深度稍深以模擬思考，P2 較淺
         depth = 3 if current_player == 1 else 2 
         
-        move = get_best_move(lines, triangles, dots_flat, current_player, w, depth)
+        move = get_best_move(lines, triangles, dots_flat, current_player, w, depth, line_tris, move_table)
         
         if not move:
             print("無步可走，遊戲結束。")